@@ -4,21 +4,51 @@
 Reads an Overpass QL query from query/playquery.ql, executes it against
 multiple Overpass API endpoints with fallback, converts the response to
 GeoJSON where every feature is a Point (nodes use lat/lon; ways/relations
-use 'center' or bounds fallback), and writes data/funmap.geojson.
+use 'center' or bounds fallback), and writes data/funmap.geojson plus a
+newline-delimited copy (one Feature per line) in data/funmap.geojsonl.
 
-Zero external dependencies — stdlib only.
+Zero required dependencies — stdlib only. If orjson is installed it is
+used for JSON parsing and serialization; otherwise the stdlib json module
+is used. If ijson is installed the Overpass response is stream-parsed
+element by element instead of being buffered in full.
 
 IMPORTANT:
 Your Overpass query must include:  out center;
 """
 
-import json
+import contextlib
+import gzip
+import http.client
+import mmap
 import os
+import random
+import re
+import socket
 import sys
+import threading
 import time
+import urllib.error
 import urllib.parse
-import urllib.request
-from datetime import datetime, timezone
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
+try:
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+
+if ijson is not None:
+    from ijson.common import ObjectBuilder
 
 OVERPASS_ENDPOINTS = [
     "https://overpass-api.de/api/interpreter",
@@ -29,20 +59,98 @@ OVERPASS_ENDPOINTS = [
 
 QUERY_FILE = "query/playquery.ql"
 OUTPUT_FILE = "data/funmap.geojson"
+OUTPUT_SEQ_FILE = "data/funmap.geojsonl"
 
 DEFAULT_DROP_THRESHOLD = 50  # percent
 DEFAULT_MAX_DATA_LAG_HOURS = 48
 REQUEST_TIMEOUT = 180  # seconds
-
-# Retry behavior: if ALL endpoints fail, wait 60 minutes and try again once.
+CONNECT_TIMEOUT = 10   # seconds
+
+# HTTP-level retry on the same (kept-alive) connection for transient errors.
+HTTP_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 1.5        # seconds; doubled on each attempt
+HTTP_RETRY_STATUSES = (429, 502, 503, 504)
+# A longer Retry-After is not slept through: the endpoint fails and its
+# breaker stays open for the advertised time instead.
+MAX_RETRY_AFTER_SECONDS = 60
+
+# Request bodies at least this large are sent gzip-compressed
+# (Content-Encoding: gzip). On a 400 or 415 the plain body is sent once;
+# servers that ignore the header read the gzip bytes as query text and
+# answer 400. Only if the plain body then succeeds is the endpoint sent
+# plain bodies for the rest of the process; a 400 on the plain body is a
+# real query error.
+COMPRESS_BODY_MIN_BYTES = 4096
+
+# Hedged dispatch: start the next endpoint if the current ones have not
+# answered within this delay (or as soon as one fails). Area queries over
+# the region's admin relations typically take tens of seconds, so a
+# shorter delay would put every healthy run on all mirrors at once.
+HEDGE_DELAY_SECONDS = 60
+
+# Per-endpoint circuit breaker: after this many consecutive failures an
+# endpoint is tried last until the cooldown (or its Retry-After) expires.
+BREAKER_FAILURE_THRESHOLD = 1
+BREAKER_COOLDOWN_SECONDS = 10 * 60
+
+# Retry behavior: if ALL endpoints fail, wait until a mirror reports a free
+# query slot on /api/status (at most 60 minutes) and try again once.
 RETRY_ROUNDS = 2                 # total rounds (initial + 1 retry)
-RETRY_DELAY_SECONDS = 60 * 60    # 60 minutes
+RETRY_DELAY_SECONDS = 60 * 60    # 60 minutes; also used if no status is known
+MIN_RETRY_DELAY_SECONDS = 60     # give stale/overloaded mirrors some time
 
 # Generic env var names
 ENV_DROP_THRESHOLD = "FUNMAP_DROP_THRESHOLD"
 ENV_MAX_DATA_LAG_HOURS = "FUNMAP_MAX_DATA_LAG_HOURS"
 ENV_USER_AGENT = "FUNMAP_USER_AGENT"
 
+# Overpass /api/status lines, e.g. "2 slots available now." or
+# "Slot available after: 2024-01-01T00:00:00Z, in 25 seconds."
+SLOTS_AVAILABLE_RE = re.compile(r"^(\d+) slots? available now", re.MULTILINE)
+SLOT_WAIT_RE = re.compile(r"in (-?\d+) seconds")
+NO_RATE_LIMIT_RE = re.compile(r"^Rate limit: 0\s*$", re.MULTILINE)
+
+# Overpass timestamps are always in this fixed form, which sorts
+# lexicographically in chronological order.
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+TIMESTAMP_RE = re.compile(r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ")
+
+# Matches "out center" with any (or no) whitespace between the words.
+OUT_CENTER_RE = re.compile(r"out\s*center", re.IGNORECASE)
+
+
+# ---------------------------------------------------------------------------
+# Errors (only main() turns these into an exit status)
+# ---------------------------------------------------------------------------
+
+class QueryError(Exception):
+    """The Overpass query file is missing or empty."""
+
+
+class FetchError(Exception):
+    """No Overpass endpoint returned fresh, readable data."""
+
+
+class SafetyCheckError(Exception):
+    """The new feature count dropped too far below the previous output."""
+
+
+# ---------------------------------------------------------------------------
+# JSON helpers (orjson when available, stdlib json otherwise)
+# ---------------------------------------------------------------------------
+
+def json_loads(raw: bytes):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def json_dumps(obj) -> bytes:
+    """Serialize compactly (no indentation) to UTF-8 bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
 
 # ---------------------------------------------------------------------------
 # Query reading
@@ -53,15 +161,12 @@ def read_query(path: str) -> str:
         with open(path, "r", encoding="utf-8") as f:
             query = f.read().strip()
     except FileNotFoundError:
-        print(f"Error: Query file '{path}' not found.", file=sys.stderr)
-        sys.exit(1)
+        raise QueryError(f"Query file '{path}' not found.") from None
 
     if not query:
-        print(f"Error: Query file '{path}' is empty.", file=sys.stderr)
-        sys.exit(1)
+        raise QueryError(f"Query file '{path}' is empty.")
 
-    compact = query.replace(" ", "").replace("\n", "").lower()
-    if "outcenter" not in compact:
+    if not OUT_CENTER_RE.search(query):
         print(
             "Warning: Query does not appear to include 'out center;'. "
             "Ways/relations may be skipped.",
@@ -75,88 +180,482 @@ def read_query(path: str) -> str:
 # Overpass API fetching
 # ---------------------------------------------------------------------------
 
-def check_data_freshness(data: dict, max_lag_hours: float) -> bool:
+def freshness_cutoff(max_lag_hours: float) -> str:
+    """Oldest acceptable data timestamp, in Overpass's timestamp format."""
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=max_lag_hours)
+    return cutoff.strftime(TIMESTAMP_FORMAT)
+
+
+def check_data_freshness(data: dict, cutoff: str) -> bool:
     timestamp_str = data.get("osm3s", {}).get("timestamp_osm_base", "")
     if not timestamp_str:
         return True
 
+    if TIMESTAMP_RE.fullmatch(timestamp_str):
+        return timestamp_str >= cutoff
+
     try:
         data_time = datetime.fromisoformat(timestamp_str.replace("Z", "+00:00"))
-        now = datetime.now(timezone.utc)
-        lag_hours = (now - data_time).total_seconds() / 3600
-        return lag_hours <= max_lag_hours
+        cutoff_time = datetime.strptime(cutoff, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+        return data_time >= cutoff_time
     except Exception:
         # If timestamp parsing fails, don't fail the run.
         return True
 
 
-def fetch_overpass(query: str) -> dict:
+# One kept-alive connection per endpoint, reused across HTTP retries and
+# retry rounds so repeat requests skip the TCP + TLS handshake.
+# The lock keeps get_connection and abort_connection consistent when a
+# hedged request is aborted from another thread.
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def new_connection(url: str):
+    parts = urllib.parse.urlsplit(url)
+    conn_cls = (
+        http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    )
+    return conn_cls(parts.netloc, timeout=CONNECT_TIMEOUT)
+
+
+def get_connection(endpoint: str, cancel=None):
+    """Return a connected connection for endpoint.
+
+    Connecting happens outside the lock. If the request was cancelled (or
+    the connection aborted) meanwhile, the new connection is closed and
+    FetchError is raised instead of returning it.
+    """
+    with _connections_lock:
+        if cancel is not None and cancel.is_set():
+            raise FetchError("cancelled")
+        conn = _connections.get(endpoint)
+        if conn is None:
+            conn = new_connection(endpoint)
+            _connections[endpoint] = conn
+    if conn.sock is None:
+        conn.connect()
+        conn.sock.settimeout(REQUEST_TIMEOUT)
+
+    with _connections_lock:
+        if _connections.get(endpoint) is conn and not (cancel is not None and cancel.is_set()):
+            return conn
+    conn.close()
+    raise FetchError("cancelled")
+
+
+def close_connection(endpoint: str) -> None:
+    with _connections_lock:
+        conn = _connections.pop(endpoint, None)
+    if conn is not None:
+        conn.close()
+
+
+def abort_connection(endpoint: str) -> None:
+    """Close an endpoint's connection, interrupting a read blocked in another thread.
+
+    A connect still in progress is not interrupted, but get_connection
+    closes that connection once it notices it is no longer registered.
+    """
+    with _connections_lock:
+        conn = _connections.pop(endpoint, None)
+    if conn is None:
+        return
+    if conn.sock is not None:
+        try:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    conn.close()
+
+
+def parse_retry_after(value):
+    """Return a Retry-After header (seconds or HTTP date) as seconds, or None."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+        return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt: int, retry_after) -> float:
+    if retry_after is not None:
+        return retry_after
+    # Exponential backoff with +/-20% jitter.
+    return HTTP_BACKOFF_FACTOR * (2 ** attempt) * random.uniform(0.8, 1.2)
+
+
+def backoff(delay: float, cancel) -> None:
+    """Sleep before a retry; raise FetchError if cancel is set meanwhile."""
+    if cancel is None:
+        time.sleep(delay)
+    elif cancel.wait(delay):
+        raise FetchError("cancelled")
+
+
+def post_overpass(endpoint: str, body: bytes, headers: dict, cancel=None):
+    """POST a query and return the open 200 response.
+
+    Transient statuses, failed connects and dropped kept-alive connections
+    are retried with backoff on the same host. A read timeout is not: the
+    server is still running the query, so re-sending it would only repeat
+    the wait. Other statuses raise urllib.error.HTTPError.
+
+    cancel is an optional threading.Event: once set (a hedged request lost
+    the race), no further attempt is made and FetchError is raised.
+    """
+    path = urllib.parse.urlsplit(endpoint).path
+    for attempt in range(HTTP_RETRIES + 1):
+        if cancel is not None and cancel.is_set():
+            raise FetchError("cancelled")
+        try:
+            conn = get_connection(endpoint, cancel)
+        except OSError:
+            # Connect error or connect timeout.
+            close_connection(endpoint)
+            if attempt == HTTP_RETRIES:
+                raise
+            backoff(retry_delay(attempt, None), cancel)
+            continue
+
+        # The race may have been decided while connecting.
+        if cancel is not None and cancel.is_set():
+            close_connection(endpoint)
+            raise FetchError("cancelled")
+        try:
+            conn.request("POST", path, body=body, headers=headers)
+            resp = conn.getresponse()
+        except socket.timeout:
+            close_connection(endpoint)
+            raise
+        except (http.client.HTTPException, OSError):
+            # Typically a kept-alive connection the server already dropped.
+            close_connection(endpoint)
+            if attempt == HTTP_RETRIES:
+                raise
+            backoff(retry_delay(attempt, None), cancel)
+            continue
+
+        if resp.status == 200:
+            return resp
+
+        # Drain the error body so the connection can be reused.
+        resp.read()
+        retry_after = parse_retry_after(resp.getheader("Retry-After"))
+        if (
+            resp.status not in HTTP_RETRY_STATUSES
+            or attempt == HTTP_RETRIES
+            or (retry_after or 0) > MAX_RETRY_AFTER_SECONDS
+        ):
+            raise urllib.error.HTTPError(endpoint, resp.status, resp.reason, resp.headers, None)
+
+        delay = retry_delay(attempt, retry_after)
+        print(f"  HTTP {resp.status}, retrying in {delay:.1f}s...", file=sys.stderr, flush=True)
+        backoff(delay, cancel)
+
+
+def stream_elements(resp, events, endpoint: str):
+    """Yield Overpass elements one at a time from an ijson event stream.
+
+    The stream is read to EOF (the trailing "remark" is tiny) so the
+    kept-alive connection is left clean for reuse. Object keys are interned:
+    unlike json/orjson, ijson does not share repeated key strings, and the
+    tag key space is tiny compared to the number of elements.
+
+    A read timeout, truncated body or malformed JSON here is raised as
+    FetchError, so the race treats it like any other endpoint failure.
+    """
+    try:
+        builder = None
+        for prefix, event, value in events:
+            if builder is None:
+                if prefix == "elements.item" and event == "start_map":
+                    builder = ObjectBuilder()
+                    builder.event(event, value)
+                continue
+
+            if event == "map_key":
+                value = sys.intern(value)
+            builder.event(event, value)
+            if prefix == "elements.item" and event == "end_map":
+                yield builder.value
+                builder = None
+    except Exception as e:
+        raise FetchError(f"Reading response from {endpoint} failed: {e}") from e
+    finally:
+        resp.close()
+
+
+def response_body(resp):
+    """Return a file-like over the decoded body of an Overpass response."""
+    if (resp.getheader("Content-Encoding") or "").lower() == "gzip":
+        return gzip.GzipFile(fileobj=resp)
+    return resp
+
+
+def read_overpass_response(resp, endpoint: str):
+    """Return (elements iterator, metadata dict) for an open Overpass response.
+
+    With ijson the body is consumed only up to the start of the "elements"
+    array (Overpass emits "osm3s" first), so the freshness check can run
+    before any element is parsed. Without ijson the body is buffered.
+    """
+    body = response_body(resp)
+    if ijson is None:
+        try:
+            data = json_loads(body.read())
+        finally:
+            resp.close()
+        return iter(data.get("elements", [])), {"osm3s": data.get("osm3s", {})}
+
+    events = ijson.parse(body, use_float=True)
+    osm3s = {}
+    for prefix, event, value in events:
+        if prefix == "osm3s.timestamp_osm_base":
+            osm3s["timestamp_osm_base"] = value
+        elif prefix == "elements" and event == "start_array":
+            break
+    return stream_elements(resp, events, endpoint), {"osm3s": osm3s}
+
+
+# endpoint -> {"failures": int, "open_until": float}; lives for the process.
+_breakers = {}
+
+
+def breaker_open(endpoint: str) -> bool:
+    state = _breakers.get(endpoint)
+    return state is not None and state["open_until"] > time.monotonic()
+
+
+def record_failure(endpoint: str, error: Exception) -> None:
+    state = _breakers.setdefault(endpoint, {"failures": 0, "open_until": 0.0})
+    state["failures"] += 1
+
+    cooldown = None
+    if isinstance(error, urllib.error.HTTPError) and error.headers is not None:
+        # Respect the server-advertised cooldown when there is one.
+        cooldown = parse_retry_after(error.headers.get("Retry-After"))
+    if cooldown is not None:
+        state["open_until"] = time.monotonic() + cooldown
+    elif state["failures"] >= BREAKER_FAILURE_THRESHOLD:
+        state["open_until"] = time.monotonic() + BREAKER_COOLDOWN_SECONDS
+
+
+def record_success(endpoint: str) -> None:
+    _breakers.pop(endpoint, None)
+
+
+# Endpoints that rejected a gzip-compressed request body.
+_plain_body_endpoints = set()
+
+
+def post_query(endpoint: str, body: bytes, headers: dict, cancel=None):
+    if len(body) < COMPRESS_BODY_MIN_BYTES or endpoint in _plain_body_endpoints:
+        return post_overpass(endpoint, body, headers, cancel)
+
+    try:
+        return post_overpass(
+            endpoint, gzip.compress(body), {**headers, "Content-Encoding": "gzip"}, cancel
+        )
+    except urllib.error.HTTPError as e:
+        if e.code not in (400, 415):
+            raise
+
+    resp = post_overpass(endpoint, body, headers, cancel)
+    _plain_body_endpoints.add(endpoint)
+    return resp
+
+
+def try_endpoint(endpoint: str, body: bytes, headers: dict, cutoff: str, cancel=None):
+    """Fetch and convert one endpoint's response; return (features, metadata).
+
+    The whole response is read and converted here, inside the race, so a
+    body that breaks off mid-stream fails over to the next endpoint just
+    like a failed request. Serialized features (not the raw response) are
+    materialized because the safety check needs the final count before the
+    output is touched.
+    """
+    print(f"Trying {endpoint} ...", flush=True)
+    resp = post_query(endpoint, body, headers, cancel)
+    try:
+        elements, meta = read_overpass_response(resp, endpoint)
+        if not check_data_freshness(meta, cutoff):
+            raise FetchError("data too stale")
+        features = list(elements_to_features(elements))
+    except Exception:
+        # The body may not have been read to the end, so the connection
+        # cannot be reused.
+        close_connection(endpoint)
+        raise
+
+    return features, meta
+
+
+def race_endpoints(endpoints: list, body: bytes, headers: dict, cutoff: str):
+    """Query endpoints with hedging; return (result, last_endpoint, last_error).
+
+    The first endpoint starts immediately. Another is started whenever one
+    fails, or when nothing has answered for HEDGE_DELAY_SECONDS. The first
+    fresh response wins; the others are cancelled (no further retries) and
+    their connections are closed.
+    """
+    remaining = list(endpoints)
+    pending = {}
+    last_endpoint = None
+    last_error = None
+
+    executor = ThreadPoolExecutor(max_workers=len(endpoints))
+    try:
+        launch = 1
+        while remaining or pending:
+            for _ in range(min(launch, len(remaining))):
+                endpoint = remaining.pop(0)
+                cancel = threading.Event()
+                future = executor.submit(try_endpoint, endpoint, body, headers, cutoff, cancel)
+                pending[future] = (endpoint, cancel)
+
+            done, _ = wait(
+                pending,
+                timeout=HEDGE_DELAY_SECONDS if remaining else None,
+                return_when=FIRST_COMPLETED,
+            )
+            launch = 0 if done else 1
+
+            for future in done:
+                endpoint, _cancel = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"  {endpoint} failed: {e}", file=sys.stderr, flush=True)
+                    record_failure(endpoint, e)
+                    last_endpoint = endpoint
+                    last_error = e
+                    launch += 1
+                    continue
+
+                record_success(endpoint)
+                print(f"  Success: {endpoint}", flush=True)
+                return result, None, None
+
+        return None, last_endpoint, last_error
+    finally:
+        for future, (endpoint, cancel) in pending.items():
+            # Set cancel first so the abort below is not treated as a
+            # dropped connection and retried.
+            cancel.set()
+            # A loser may still complete after the abort; drop its connection then too.
+            future.add_done_callback(lambda _f, ep=endpoint: close_connection(ep))
+            abort_connection(endpoint)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_slot_wait(status_text: str):
+    """Return seconds until a query slot frees up per /api/status, or None."""
+    if NO_RATE_LIMIT_RE.search(status_text):
+        return 0.0
+    match = SLOTS_AVAILABLE_RE.search(status_text)
+    if match and int(match.group(1)) > 0:
+        return 0.0
+    waits = [max(0, int(w)) for w in SLOT_WAIT_RE.findall(status_text)]
+    return float(min(waits)) if waits else None
+
+
+def slot_wait_seconds(endpoint: str, user_agent: str):
+    status_url = endpoint.rsplit("/", 1)[0] + "/status"
+    conn = new_connection(status_url)
+    try:
+        conn.request("GET", urllib.parse.urlsplit(status_url).path, headers={"User-Agent": user_agent})
+        resp = conn.getresponse()
+        if resp.status != 200:
+            return None
+        return parse_slot_wait(resp.read().decode("utf-8", "replace"))
+    except (http.client.HTTPException, OSError):
+        return None
+    finally:
+        conn.close()
+
+
+def round_delay_seconds(endpoints: list, user_agent: str) -> float:
+    """How long to wait before the next round, from the mirrors' /api/status.
+
+    Uses the shortest advertised wait for a free slot across mirrors,
+    clamped to [MIN_RETRY_DELAY_SECONDS, RETRY_DELAY_SECONDS], with
+    +/-20% jitter. Falls back to RETRY_DELAY_SECONDS if no mirror answers.
+    """
+    with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+        waits = executor.map(lambda e: slot_wait_seconds(e, user_agent), endpoints)
+        waits = [w for w in waits if w is not None]
+    if not waits:
+        return RETRY_DELAY_SECONDS
+
+    delay = min(max(min(waits), MIN_RETRY_DELAY_SECONDS), RETRY_DELAY_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def fetch_overpass(query: str):
     max_lag_hours = float(os.environ.get(ENV_MAX_DATA_LAG_HOURS, DEFAULT_MAX_DATA_LAG_HOURS))
     user_agent = os.environ.get(ENV_USER_AGENT, "funmap-fetch/1.0")
-    encoded = urllib.parse.urlencode({"data": query}).encode("utf-8")
+    # Overpass QL punctuation is left unescaped; only what would break
+    # form decoding ("&", "+", "%", whitespace, non-ASCII) is quoted.
+    encoded = b"data=" + urllib.parse.quote_plus(
+        query.encode("utf-8"), safe="[](){}:;,=\"^$*!<>/|"
+    ).encode("ascii")
+    headers = {
+        "User-Agent": user_agent,
+        "Content-Type": "application/x-www-form-urlencoded",
+        "Accept-Encoding": "gzip",
+    }
 
     last_error = None
     last_endpoint = None
 
     for round_idx in range(RETRY_ROUNDS):
         if round_idx > 0:
+            delay = round_delay_seconds(OVERPASS_ENDPOINTS, user_agent)
             print(
-                f"All endpoints failed. Waiting {RETRY_DELAY_SECONDS // 60} minutes "
+                f"All endpoints failed. Waiting {delay / 60:.1f} minutes "
                 f"then retrying ({round_idx + 1}/{RETRY_ROUNDS})...",
                 file=sys.stderr,
                 flush=True,
             )
-            time.sleep(RETRY_DELAY_SECONDS)
-
-        for endpoint in OVERPASS_ENDPOINTS:
-            print(f"Trying {endpoint} ...", flush=True)
-            try:
-                req = urllib.request.Request(
-                    endpoint,
-                    data=encoded,
-                    headers={"User-Agent": user_agent},
-                )
-                with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as resp:
-                    body = resp.read().decode("utf-8")
-
-                data = json.loads(body)
-
-                if not check_data_freshness(data, max_lag_hours):
-                    print("  Data too stale, trying next server...", file=sys.stderr, flush=True)
-                    continue
+            time.sleep(delay)
 
-                print(f"  Success: {len(data.get('elements', []))} elements", flush=True)
-                return data
+        # Endpoints whose breaker is open go last in the hedge order.
+        endpoints = sorted(OVERPASS_ENDPOINTS, key=breaker_open)
 
-            except Exception as e:
-                print(f"  Failed: {e}", file=sys.stderr, flush=True)
-                last_error = e
-                last_endpoint = endpoint
+        cutoff = freshness_cutoff(max_lag_hours)
+        result, failed_endpoint, error = race_endpoints(endpoints, encoded, headers, cutoff)
+        if result is not None:
+            return result
+        last_endpoint = failed_endpoint or last_endpoint
+        last_error = error or last_error
 
-    print("Error: All Overpass endpoints failed after retry.", file=sys.stderr)
+    message = "All Overpass endpoints failed after retry."
     if last_endpoint:
-        print(f"Last endpoint tried: {last_endpoint}", file=sys.stderr)
+        message += f"\nLast endpoint tried: {last_endpoint}"
     if last_error:
-        print(f"Last error: {last_error}", file=sys.stderr)
-    sys.exit(1)
+        message += f"\nLast error: {last_error}"
+    raise FetchError(message) from last_error
 
 
 # ---------------------------------------------------------------------------
 # Convert elements to POINT GeoJSON
 # ---------------------------------------------------------------------------
 
-def element_to_feature_point(element: dict):
-    elem_type = element.get("type", "")
-    elem_id = element.get("id", 0)
-    tags = element.get("tags", {}) or {}
+# Start of every serialized Feature (dict order in element_to_feature_point).
+FEATURE_PREFIX = b'{"type":"Feature"'
 
-    properties = dict(tags)
-    properties["@id"] = f"{elem_type}/{elem_id}"
-    properties["@type"] = elem_type
+# "@id" prefixes, so the hot loop concatenates instead of formatting.
+ID_PREFIX = {"node": "node/", "way": "way/", "relation": "relation/"}
 
-    lon = None
-    lat = None
 
+def element_point(element: dict, elem_type: str):
+    """Return (lon, lat) for an element, or None if it has no point geometry."""
     if elem_type == "node":
         lon = element.get("lon")
         lat = element.get("lat")
@@ -165,76 +664,203 @@ def element_to_feature_point(element: dict):
         if center:
             lon = center.get("lon")
             lat = center.get("lat")
-        elif element.get("bounds"):
-            b = element["bounds"]
-            lon = (b["minlon"] + b["maxlon"]) / 2
-            lat = (b["minlat"] + b["maxlat"]) / 2
+        else:
+            b = element.get("bounds")
+            if not b:
+                return None
+            lon = (b["minlon"] + b["maxlon"]) * 0.5
+            lat = (b["minlat"] + b["maxlat"]) * 0.5
+    else:
+        return None
 
     if lon is None or lat is None:
         return None
+    return lon, lat
+
+
+def element_to_feature_point(element: dict):
+    """Return the element as a serialized GeoJSON Point Feature, or None.
+
+    Features are serialized here rather than kept as dicts, so only the
+    compact bytes are held until the output is written.
+    """
+    elem_type = element.get("type", "")
+
+    # Resolve geometry first so skipped elements never pay for building
+    # properties and "@id".
+    point = element_point(element, elem_type)
+    if point is None:
+        return None
+    lon, lat = point
+
+    elem_id = element.get("id", 0)
+    # The parsed element is not used again, so its tags dict is reused as
+    # the properties dict instead of being copied. A fresh dict is only
+    # allocated for untagged elements.
+    properties = element.get("tags") or {}
+    properties["@id"] = ID_PREFIX[elem_type] + str(elem_id)
+    properties["@type"] = elem_type
 
-    return {
+    return json_dumps({
         "type": "Feature",
         "geometry": {"type": "Point", "coordinates": [lon, lat]},
         "properties": properties,
-    }
+    })
 
 
-def elements_to_features(elements: list) -> list:
-    features = []
+def elements_to_features(elements):
     skipped = 0
 
     for element in elements:
         feature = element_to_feature_point(element)
         if feature:
-            features.append(feature)
+            yield feature
         else:
             skipped += 1
 
     if skipped:
         print(f"Skipped {skipped} elements without point geometry.", file=sys.stderr)
 
-    return features
-
 
 # ---------------------------------------------------------------------------
 # Safety check
 # ---------------------------------------------------------------------------
 
-def check_feature_drop(new_count: int, output_path: str, threshold: int) -> None:
-    if not os.path.exists(output_path):
-        return
+def meta_path(path: str) -> str:
+    return path + ".meta.json"
+
+
+def read_cached_feature_count(path: str):
+    """Return the feature count from the sidecar written with path, or None.
 
+    The sidecar is only trusted if it records the current file size, so a
+    GeoJSON replaced by hand is not checked against a stale count.
+    """
     try:
-        with open(output_path, "r", encoding="utf-8") as f:
-            existing = json.load(f)
-        old_count = len(existing.get("features", []))
+        with open(meta_path(path), "rb") as f:
+            meta = json_loads(f.read())
+        if meta.get("size") != os.path.getsize(path):
+            return None
+        return int(meta["feature_count"])
     except Exception:
+        return None
+
+
+def scan_feature_count(path: str) -> int:
+    """Count features by a byte scan of a file written by write_geojson.
+
+    The file is memory-mapped and searched for the compact Feature prefix
+    write_geojson emits; no JSON is parsed. The prefix cannot occur inside
+    a JSON string (its quotes would be escaped). Returns 0 if the file is
+    not in that layout.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = mm.find(b'"features":[')
+            if pos < 0:
+                return 0
+            count = 0
+            while True:
+                pos = mm.find(FEATURE_PREFIX, pos)
+                if pos < 0:
+                    return count
+                count += 1
+                pos += len(FEATURE_PREFIX)
+
+
+def count_features(path: str) -> int:
+    count = scan_feature_count(path)
+    if count:
+        return count
+
+    with open(path, "rb") as f:
+        if ijson is None:
+            return len(json_loads(f.read()).get("features", []))
+        # Count Feature objects from parse events without building them.
+        return sum(
+            1
+            for prefix, event, _ in ijson.parse(f)
+            if prefix == "features.item" and event == "start_map"
+        )
+
+
+def check_feature_drop(new_count: int, output_path: str, threshold: int) -> None:
+    if not os.path.exists(output_path):
         return
 
+    old_count = read_cached_feature_count(output_path)
+    if old_count is None:
+        try:
+            old_count = count_features(output_path)
+        except Exception:
+            return
+
     if old_count == 0:
         return
 
     drop_pct = ((old_count - new_count) / old_count) * 100
     if drop_pct > threshold:
-        print(
-            f"SAFETY CHECK FAILED: {old_count} -> {new_count} "
-            f"({drop_pct:.1f}% drop). Aborting.",
-            file=sys.stderr,
+        raise SafetyCheckError(
+            f"{old_count} -> {new_count} ({drop_pct:.1f}% drop). Aborting."
         )
-        sys.exit(1)
 
 
 # ---------------------------------------------------------------------------
 # Output
 # ---------------------------------------------------------------------------
 
-def write_geojson(features: list, path: str) -> None:
+@contextlib.contextmanager
+def atomic_write(path: str):
+    """Write to path + ".tmp", then fsync and os.replace it over path.
+
+    A crash mid-write leaves the previous file intact instead of a
+    truncated one that would trip the next run's safety check.
+    """
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+        raise
+
+
+def write_geojson(features, path: str, seq_path: str = None) -> None:
+    """Write serialized features as a FeatureCollection, one Feature per line.
+
+    If seq_path is given, the same lines are also written there as
+    newline-delimited GeoJSON (no envelope). A small sidecar recording the
+    feature count and file size is written next to path for the next run's
+    safety check.
+    """
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    geojson = {"type": "FeatureCollection", "features": features}
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(geojson, f, ensure_ascii=False, indent=2)
-        f.write("\n")
+    with contextlib.ExitStack() as stack:
+        f = stack.enter_context(atomic_write(path))
+        seq = stack.enter_context(atomic_write(seq_path)) if seq_path else None
+
+        f.write(b'{"type":"FeatureCollection","features":[\n')
+        sep = b""
+        count = 0
+        for line in features:
+            f.write(sep)
+            f.write(line)
+            sep = b",\n"
+            count += 1
+            if seq is not None:
+                seq.write(line)
+                seq.write(b"\n")
+        f.write(b"\n]}\n")
+
+    meta = {"feature_count": count, "size": os.path.getsize(path)}
+    with atomic_write(meta_path(path)) as f:
+        f.write(json_dumps(meta))
+        f.write(b"\n")
 
 
 # ---------------------------------------------------------------------------
@@ -242,20 +868,28 @@ def write_geojson(features: list, path: str) -> None:
 # ---------------------------------------------------------------------------
 
 def main() -> None:
-    query = read_query(QUERY_FILE)
-    data = fetch_overpass(query)
+    try:
+        query = read_query(QUERY_FILE)
+        features, _meta = fetch_overpass(query)
 
-    elements = data.get("elements", [])
-    features = elements_to_features(elements)
+        if not features:
+            print("Error: No usable POINT features returned.", file=sys.stderr)
+            sys.exit(1)
 
-    if not features:
-        print("Error: No usable POINT features returned.", file=sys.stderr)
-        sys.exit(1)
+        print(f"Converted {len(features)} features.")
 
-    print(f"Converted {len(features)} features.")
+        threshold = int(os.environ.get(ENV_DROP_THRESHOLD, DEFAULT_DROP_THRESHOLD))
+        check_feature_drop(len(features), OUTPUT_FILE, threshold)
+
+        write_geojson(features, OUTPUT_FILE, OUTPUT_SEQ_FILE)
+        print(f"Wrote {OUTPUT_FILE} and {OUTPUT_SEQ_FILE}.")
+    except (QueryError, FetchError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    except SafetyCheckError as e:
+        print(f"SAFETY CHECK FAILED: {e}", file=sys.stderr)
+        sys.exit(1)
 
-    threshold = int(os.environ.get(ENV_DROP_THRESHOLD, DEFAULT_DROP_THRESHOLD))
-    check_feature_drop(len(features), OUTPUT_FILE, threshold)
 
-    write_geojson(features, OUTPUT_FILE)
-    pr
+if __name__ == "__main__":
+    main()